@@ -1,11 +1,13 @@
 import os
 from pathlib import Path
 import io
+import json
 
 import streamlit as st
 import pandas as pd
 import numpy as np
-from PIL import Image
+import pyarrow as pa
+import pyarrow.parquet as pq
 import altair as alt  # NEW: para barras bonitas e interactivas
 
 # ---------------------------
@@ -14,9 +16,42 @@ import altair as alt  # NEW: para barras bonitas e interactivas
 ROOT = Path(__file__).resolve().parents[1]
 DATA_PROCESSED = ROOT / "data" / "processed"
 PNG_MAP = DATA_PROCESSED / "tmin_choropleth.png"
+BUNDLE   = DATA_PROCESSED / "tmin_bundle.parquet"
 CSV_MAIN = DATA_PROCESSED / "tmin_zonal_distritos.csv"
 CSV_TOP  = DATA_PROCESSED / "top15_tmin_mean_alta.csv"
 CSV_BOT  = DATA_PROCESSED / "top15_tmin_mean_baja.csv"
+CSV_COMP = DATA_PROCESSED / "tmin_comparacion_productos.csv"
+HIST_JSON = DATA_PROCESSED / "histogramas_tmin.json"
+
+# Series disponibles en el artefacto de histogramas (clave JSON → etiqueta)
+HIST_SERIES = {
+    "pixels": "Píxeles del ráster (Tmin °C)",
+    "mean": "Tmin media por distrito (°C)",
+    "min": "Tmin mínima por distrito (°C)",
+    "max": "Tmin máxima por distrito (°C)",
+    "percentile_10": "P10 por distrito (°C)",
+    "percentile_90": "P90 por distrito (°C)",
+    "risk_index": "Índice de riesgo por frío",
+}
+# Solo para el histograma calculado al vuelo (sin JSON); con artefacto manda su "bin_width"
+FALLBACK_BIN_WIDTH = 0.5
+
+# Normaliza nombres esperados si existen
+COL_RENAME = {
+    "percentile_10": "p10",
+    "percentile_90": "p90",
+    "diff_percentile_10": "diff_p10",
+    "diff_percentile_90": "diff_p90"
+}
+DIFF_COLS = ["diff_mean", "diff_p10", "diff_p90"]
+
+# Secciones de la app (solo se ejecuta la activa)
+PAGE_MAP   = "🗺️ Mapa coroplético"
+PAGE_HIST  = "📈 Distribución (Histograma)"
+PAGE_RANK  = "📊 Top / Bottom 15"
+PAGE_SUM   = "🧾 Resumen y descargas"
+PAGE_POL   = "🏛️ Políticas públicas"
+PAGES = [PAGE_MAP, PAGE_HIST, PAGE_RANK, PAGE_SUM, PAGE_POL]
 
 st.set_page_config(
     page_title="Tmin Perú – Análisis ráster",
@@ -100,6 +135,61 @@ def make_bar_chart(df: pd.DataFrame, metric: str, color: str = "#4E79A7", sort:
     )
     return chart
 
+# --- Histograma + KDE Altair (desde conteos precomputados) ---
+def make_hist_chart(h: dict, bin_width: float, y_title: str):
+    """
+    h: serie del artefacto de histogramas ('start', 'counts', 'mean', 'median' y opcionalmente 'kde').
+    Dibuja barras + curva KDE + líneas de media/mediana sin pasar por matplotlib.
+    """
+    counts = np.asarray(h["counts"])
+    x0 = h["start"] + bin_width * np.arange(len(counts))
+    bars_df = pd.DataFrame({"x0": x0, "x1": x0 + bin_width, "n": counts})
+
+    bars = (
+        alt.Chart(bars_df)
+        .mark_bar(color="#87CEEB", stroke="black", strokeWidth=0.3)
+        .encode(
+            x=alt.X("x0:Q", title="°C"),
+            x2="x1:Q",
+            y=alt.Y("n:Q", title=y_title),
+            tooltip=[
+                alt.Tooltip("x0:Q", title="Desde", format=".1f"),
+                alt.Tooltip("x1:Q", title="Hasta", format=".1f"),
+                alt.Tooltip("n:Q", title=y_title, format=","),
+            ],
+        )
+    )
+    layers = [bars]
+
+    if h.get("kde"):
+        kde_df = pd.DataFrame({"x": np.linspace(*h["kde_range"], len(h["kde"])), "n": h["kde"]})
+        layers.append(alt.Chart(kde_df).mark_line(color="#1f4e79").encode(x="x:Q", y="n:Q"))
+
+    rules_df = pd.DataFrame({
+        "x": [h["mean"], h["median"]],
+        "stat": [f"Media: {h['mean']:.2f}°C", f"Mediana: {h['median']:.2f}°C"],
+    })
+    layers.append(
+        alt.Chart(rules_df)
+        .mark_rule(strokeDash=[6, 4])
+        .encode(
+            x="x:Q",
+            color=alt.Color("stat:N", scale=alt.Scale(range=["red", "green"]), title=None),
+        )
+    )
+    return alt.layer(*layers).properties(height=360).interactive()
+
+def hist_from_values(values: pd.Series, bin_width: float = FALLBACK_BIN_WIDTH) -> dict | None:
+    """Histograma (sin KDE) calculado al vuelo cuando no existe el artefacto precomputado."""
+    v = pd.to_numeric(values, errors="coerce").dropna().to_numpy()
+    if v.size == 0:
+        return None
+    start = np.floor(v.min() / bin_width) * bin_width
+    edges = np.arange(start, v.max() + 1.5 * bin_width, bin_width)
+    counts, _ = np.histogram(v, bins=edges)
+    return {"start": float(start), "counts": counts.tolist(),
+            "mean": float(v.mean()), "median": float(np.median(v))}
+
 # --- Tablas bonitas (Paso 4) ---
 def style_table(df: pd.DataFrame, metric_cols: list[str], cmap: str = "YlGnBu"):
     """
@@ -127,25 +217,53 @@ def fmt_int(x: float | int) -> str:
 # ---------------------------
 # Utilidades
 # ---------------------------
+def file_mtime_ns(path: Path) -> int:
+    """Fecha de modificación para la clave de caché: al regenerar un artefacto se vuelve a leer."""
+    return path.stat().st_mtime_ns if path.exists() else 0
+
 @st.cache_data
-def load_csv(path: Path) -> pd.DataFrame:
+def load_csv(path: Path, mtime_ns: int) -> pd.DataFrame:
     if not path.exists():
         return pd.DataFrame()
     df = pd.read_csv(path)
-    # Normaliza nombres esperados si existen
-    rename = {
-        "percentile_10": "p10",
-        "percentile_90": "p90"
-    }
-    df = df.rename(columns=rename)
-    return df
+    return df.rename(columns=COL_RENAME)
 
 @st.cache_data
-def load_image(path: Path):
+def load_bundle(path: Path, mtime_ns: int) -> tuple[pd.DataFrame, dict]:
+    """
+    Tabla principal + metadatos de la corrida desde el bundle Parquet
+    generado por `scripts/zonal_stats.py` (una sola lectura al arrancar).
+    Si falta o no se puede leer, devuelve una tabla vacía y la app usa el CSV.
+    """
+    if not path.exists():
+        return pd.DataFrame(), {}
+    try:
+        table = pq.read_table(path)
+    except (pa.ArrowInvalid, OSError):
+        return pd.DataFrame(), {}
+    raw_meta = (table.schema.metadata or {}).get(b"tmin_meta")
+    meta = json.loads(raw_meta) if raw_meta else {}
+    return table.to_pandas().rename(columns=COL_RENAME), meta
+
+@st.cache_data
+def load_histograms(path: Path, mtime_ns: int) -> dict:
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8"))
+
+# Bytes inmutables → st.cache_resource: una sola copia compartida por todas las sesiones
+# (st.cache_data devolvería una copia nueva en cada llamada)
+@st.cache_resource(show_spinner=False)
+def _read_artifact(path: Path, mtime_ns: int) -> bytes:
+    return path.read_bytes()
+
+def read_artifact(path: Path) -> bytes | None:
+    """Bytes de un artefacto para descarga; la fecha de modificación invalida la caché al regenerarlo."""
     if path.exists():
-        return Image.open(path)
+        return _read_artifact(path, file_mtime_ns(path))
     return None
 
+@st.cache_resource(show_spinner=False, max_entries=32)
 def bytes_from_df(df: pd.DataFrame) -> bytes:
     buf = io.StringIO()
     df.to_csv(buf, index=False)
@@ -154,23 +272,41 @@ def bytes_from_df(df: pd.DataFrame) -> bytes:
 # ---------------------------
 # Carga de datos
 # ---------------------------
-df = load_csv(CSV_MAIN)
-top = load_csv(CSV_TOP)
-bot = load_csv(CSV_BOT)
-img = load_image(PNG_MAP)
-
-# Si faltan top/bottom, los calculamos desde df
-if df.shape[0] > 0 and (top.shape[0] == 0 or bot.shape[0] == 0):
-    rank_cols = [c for c in ["UBIGEO","DEPARTAMENTO","PROVINCIA","DISTRITO"] if c in df.columns]
-    rank_cols += [c for c in ["mean","p10","p90","risk_index","risk_flag"] if c in df.columns]
-    top = df.sort_values("mean", ascending=False).head(15)[rank_cols].copy()
-    bot = df.sort_values("mean", ascending=True ).head(15)[rank_cols].copy()
+df, meta = load_bundle(BUNDLE, file_mtime_ns(BUNDLE))
+if df.shape[0] == 0:
+    # Respaldo mientras no exista el bundle (o si está dañado)
+    df = load_csv(CSV_MAIN, file_mtime_ns(CSV_MAIN))
 
 # ---------------------------
 # Encabezado
 # ---------------------------
 st.title("Temperatura mínima en Perú (Tmin) – Análisis ráster")
-st.caption("Repositorio: **Minimum-Temperature-Raster** · App Streamlit")
+st.caption("Repositorio: **Minimum-Temperature-Raster** · App Streamlit"
+           + (f" · Datos generados: {meta['generated_at']}" if meta.get("generated_at") else ""))
+
+# Producto Tmin activo: el bundle trae una fila por distrito y producto (fuente/periodo)
+ref_prod = meta.get("reference")
+prods = df["PRODUCTO"].dropna().unique().tolist() if "PRODUCTO" in df.columns else []
+sel_prod = prods[0] if prods else ref_prod
+if len(prods) > 1:
+    sel_prod = st.selectbox(
+        "Producto Tmin",
+        prods,
+        index=prods.index(ref_prod) if ref_prod in prods else 0,
+        help=f"Diferencias (diff_*) calculadas respecto al producto de referencia: {ref_prod}."
+    )
+if prods:
+    df = df[df["PRODUCTO"] == sel_prod].drop(columns="PRODUCTO").reset_index(drop=True)
+    if sel_prod == ref_prod:
+        df = df.drop(columns=[c for c in DIFF_COLS if c in df.columns])
+
+# Top/bottom se calculan desde df (los CSV de ranking solo se leen al descargarlos)
+top = bot = pd.DataFrame()
+if df.shape[0] > 0:
+    rank_cols = [c for c in ["UBIGEO","DEPARTAMENTO","PROVINCIA","DISTRITO"] if c in df.columns]
+    rank_cols += [c for c in ["mean","p10","p90","risk_index","risk_flag"] if c in df.columns]
+    top = df.sort_values("mean", ascending=False).head(15)[rank_cols].copy()
+    bot = df.sort_values("mean", ascending=True ).head(15)[rank_cols].copy()
 
 # KPI rápidos si hay datos (Paso 5 con separadores y emojis)
 if df.shape[0] > 0:
@@ -178,73 +314,100 @@ if df.shape[0] > 0:
 
     c1.metric("🧩 Distritos", fmt_int(df.shape[0]))
     if "mean" in df:
-        c2.metric("🌡️ Tmin media (°C)", fmt_float(df["mean"].mean(), 2))
+        delta = f"{df['diff_mean'].mean():+.2f} vs {ref_prod}" if "diff_mean" in df else None
+        c2.metric("🌡️ Tmin media (°C)", fmt_float(df["mean"].mean(), 2), delta=delta, delta_color="off")
     if "p10" in df:
         c3.metric("🧊 P10 promedio (°C)", fmt_float(df["p10"].mean(), 2))
     if "risk_flag" in df:
         c4.metric("🚩 Tmin < 0°C (n° distritos)", fmt_int(df["risk_flag"].sum()))
 
 # ---------------------------
-# Pestañas
+# Secciones
+#   → selector en lugar de st.tabs: st.tabs ejecuta todas las pestañas en cada rerun,
+#     aquí solo se carga lo que necesita la sección activa
 # ---------------------------
-tab1, tab_hist, tab2, tab3, tab4 = st.tabs([
-    "🗺️ Mapa coroplético",
-    "📈 Distribución (Histograma)",
-    "📊 Top / Bottom 15",
-    "🧾 Resumen y descargas",
-    "🏛️ Políticas públicas"
-])
+page = st.radio("Sección", PAGES, horizontal=True, label_visibility="collapsed", key="page")
 # ===========
 # TAB 1: MAPA
 # ===========
-with tab1:
+if page == PAGE_MAP:
     st.subheader("Mapa coroplético – Tmin media por distrito")
-    if img is not None:
+    if PNG_MAP.exists():
         # Ancho completo con borde/sombra (controlado vía CSS) + caption estilizado + descarga
-        st.image(img, use_container_width=True)
+        # (se pasa la ruta: Streamlit sirve el archivo sin decodificarlo con PIL)
+        st.image(str(PNG_MAP), use_container_width=True)
         st.markdown(
             "<div class='map-caption'>Coropleta de Tmin media (GeoPandas) · Fuente: procesamiento propio</div>",
             unsafe_allow_html=True
         )
         # Info técnica y botón de descarga
         st.info("Este mapa se genera en el script `scripts/zonal_stats.py` y se guarda en `data/processed/tmin_choropleth.png`.")
+        if sel_prod != ref_prod:
+            st.caption(f"El mapa estático corresponde al producto de referencia ({ref_prod}).")
         col_dl, _ = st.columns([1, 3])
         with col_dl:
             st.download_button(
                 "📥 Descargar PNG del mapa",
-                data=PNG_MAP.read_bytes() if PNG_MAP.exists() else None,
+                data=read_artifact(PNG_MAP),
                 file_name=PNG_MAP.name,
-                disabled=not PNG_MAP.exists(),
                 help="Exporta la imagen del mapa para informes o presentaciones."
             )
     else:
         st.warning("No se encontró el mapa PNG. Asegúrate de ejecutar el script y de que exista `data/processed/tmin_choropleth.png`.")
-with tab_hist:
-    st.subheader("Distribución de la temperatura mínima promedio (°C)")
-    hist_path = DATA_PROCESSED / "histograma_tmin.png"
-    
-    if hist_path.exists():
-        st.image(str(hist_path),
-                 caption="Histograma de la Tmin promedio (°C) en distritos del Perú",
-                 use_container_width=True)
-        st.info("Este gráfico muestra cómo se distribuyen las temperaturas mínimas promedio por distrito. Ayuda a identificar zonas frías o con heladas.")
-        
-        col1, _ = st.columns([1,3])
-        with col1:
-            st.download_button(
-                "📥 Descargar histograma (PNG)",
-                data=hist_path.read_bytes(),
-                file_name="histograma_tmin.png",
-                help="Descarga la imagen para informes o presentaciones."
-            )
+elif page == PAGE_HIST:
+    st.subheader("Distribución de la temperatura mínima (°C)")
+    hists = load_histograms(HIST_JSON, file_mtime_ns(HIST_JSON))
+    scopes = hists.get("products", {}).get(sel_prod or hists.get("reference"), {})
+
+    ch1, ch2 = st.columns(2)
+    if scopes:
+        scope_opts = list(scopes.keys())
+        serie_opts = [k for k in HIST_SERIES if k in scopes.get("Nacional", {})]
+    else:
+        # Sin artefacto: histogramas por distrito calculados desde la tabla principal
+        dep_opts = sorted(df["DEPARTAMENTO"].dropna().astype(str).unique().tolist()) if "DEPARTAMENTO" in df else []
+        scope_opts = ["Nacional"] + dep_opts if df.shape[0] > 0 else []
+        serie_opts = [k for k in HIST_SERIES if COL_RENAME.get(k, k) in df.columns]
+
+    if not scope_opts or not serie_opts:
+        st.warning("No se encontró `data/processed/histogramas_tmin.json`. Ejecuta el script `scripts/zonal_stats.py` antes de abrir esta pestaña.")
     else:
-        st.warning("No se encontró el archivo `data/processed/histograma_tmin.png`. Ejecuta el script `scripts/zonal_stats.py` antes de abrir esta pestaña.")
+        sel_scope = ch1.selectbox("Ámbito", scope_opts, index=0)
+        sel_serie = ch2.selectbox("Métrica", serie_opts, index=serie_opts.index("mean") if "mean" in serie_opts else 0,
+                                  format_func=HIST_SERIES.get)
+
+        if scopes:
+            h = scopes[sel_scope].get(sel_serie)
+            bin_width = hists["bin_width"]
+        else:
+            sub = df if sel_scope == "Nacional" else df[df["DEPARTAMENTO"].astype(str) == sel_scope]
+            h = hist_from_values(sub[COL_RENAME.get(sel_serie, sel_serie)])
+            bin_width = FALLBACK_BIN_WIDTH
+            st.caption("Artefacto `histogramas_tmin.json` no disponible: histograma calculado desde la tabla de distritos (sin KDE ni píxeles).")
+
+        if h is None:
+            st.warning("No hay datos para el ámbito y la métrica seleccionados.")
+        else:
+            y_title = "Número de píxeles" if sel_serie == "pixels" else "Número de distritos"
+            st.altair_chart(make_hist_chart(h, bin_width, y_title), use_container_width=True)
+            st.info("Este gráfico muestra cómo se distribuyen las temperaturas mínimas por distrito (o por píxel del ráster). Filtra por departamento para identificar zonas frías o con heladas.")
+
+            if HIST_JSON.exists():
+                col1, _ = st.columns([1,3])
+                with col1:
+                    st.download_button(
+                        "📥 Descargar histogramas (JSON)",
+                        data=read_artifact(HIST_JSON),
+                        file_name=HIST_JSON.name,
+                        mime="application/json",
+                        help="Conteos por bin y curvas KDE por métrica y departamento."
+                    )
 
 
 # ======================
 # TAB 2: RANKINGS BARRAS
 # ======================
-with tab2:
+elif page == PAGE_RANK:
     st.subheader("Ranking de distritos")
     if top.shape[0] == 0 or bot.shape[0] == 0:
         st.warning("No se encontraron archivos de ranking. Se pueden generar desde `scripts/zonal_stats.py`.")
@@ -297,7 +460,7 @@ with tab2:
 # =========================
 # TAB 3: RESUMEN + DESCARGA
 # =========================
-with tab3:
+elif page == PAGE_SUM:
     st.subheader("Filtrado, resumen y descargas")
     if df.shape[0] == 0:
         st.warning("No se encontró `data/processed/tmin_zonal_distritos.csv`.")
@@ -332,7 +495,7 @@ with tab3:
         st.write(f"**Registros filtrados:** {fmt_int(df_view.shape[0])}")
 
         # 2 decimales + gradiente en la tabla de resumen
-        fmt_cols_view = [c for c in ["mean","p10","p90","risk_index"] if c in df_view.columns]
+        fmt_cols_view = [c for c in ["mean","p10","p90","risk_index"] + DIFF_COLS if c in df_view.columns]
         st.dataframe(
             style_table(df_view, fmt_cols_view),
             use_container_width=True,
@@ -349,22 +512,35 @@ with tab3:
         if "risk_flag" in df_view:
             k4.metric("🚩 Tmin < 0°C (n° distritos)", fmt_int(df_view["risk_flag"].sum()))
 
-        st.download_button("Descargar tabla filtrada (CSV)", data=bytes_from_df(df_view), file_name="tmin_filtrado.csv", mime="text/csv")
-
-        # Descargas “oficiales”
+        # Descargas: se preparan solo a pedido y para el filtro vigente, así los reruns
+        # por cambios de filtro no leen ni serializan archivos
         st.markdown("### Descargas")
-        cdl1, cdl2, cdl3 = st.columns(3)
-        if CSV_MAIN.exists():
-            cdl1.download_button("📥 Zonal stats (CSV)", data=CSV_MAIN.read_bytes(), file_name=CSV_MAIN.name)
-        if CSV_TOP.exists():
-            cdl2.download_button("📥 Top 15 (CSV)", data=CSV_TOP.read_bytes(), file_name=CSV_TOP.name)
-        if CSV_BOT.exists():
-            cdl3.download_button("📥 Bottom 15 (CSV)", data=CSV_BOT.read_bytes(), file_name=CSV_BOT.name)
+        filtro = (sel_prod, sel_dep, umbral, criterio)
+        if st.button("📦 Preparar descargas"):
+            st.session_state["descargas_filtro"] = filtro
+
+        if st.session_state.get("descargas_filtro") != filtro:
+            st.caption("Pulsa **Preparar descargas** para generar la tabla filtrada y los CSV del análisis.")
+        else:
+            st.download_button("Descargar tabla filtrada (CSV)", data=bytes_from_df(df_view), file_name="tmin_filtrado.csv", mime="text/csv")
+
+            # Descargas “oficiales”
+            cdl1, cdl2, cdl3 = st.columns(3)
+            if CSV_MAIN.exists():
+                cdl1.download_button("📥 Zonal stats (CSV)", data=read_artifact(CSV_MAIN), file_name=CSV_MAIN.name)
+            if CSV_TOP.exists():
+                cdl2.download_button("📥 Top 15 (CSV)", data=read_artifact(CSV_TOP), file_name=CSV_TOP.name)
+            if CSV_BOT.exists():
+                cdl3.download_button("📥 Bottom 15 (CSV)", data=read_artifact(CSV_BOT), file_name=CSV_BOT.name)
+            # Solo si la corrida actual generó la comparación (evita ofrecer un CSV de otra corrida)
+            if meta.get("artifacts", {}).get("comparison_csv") and CSV_COMP.exists():
+                st.download_button("📥 Comparación de productos (CSV)", data=read_artifact(CSV_COMP), file_name=CSV_COMP.name,
+                                   help="Estadísticas lado a lado por distrito y diferencias respecto al producto de referencia.")
 
 # =========================
 # TAB 4: POLÍTICAS PÚBLICAS
 # =========================
-with tab4:
+elif page == PAGE_POL:
     st.subheader("Propuestas de políticas públicas")
     st.markdown("""
 **Diagnóstico:**  
@@ -1,25 +1,67 @@
+# scripts/zonal_stats.py
+# Python 3.10+
+# Objetivo: estadísticas zonales de Tmin por distrito + mapa, histogramas/KDE, rankings
+#           y bundle compacto (Parquet) para el arranque de la app.
+# Uso:
+#   python scripts/zonal_stats.py                      # todo en memoria
+#   python scripts/zonal_stats.py --chunk-size 5000    # modo streaming (capas grandes)
+#   python scripts/zonal_stats.py --raster clim=data/raw/raster/tmin_clim.tif \
+#                                 --raster y2023=data/raw/raster/tmin_2023.tif   # comparación de productos
+
 import os
+import json
+import argparse
 import warnings
+from datetime import datetime, timezone
 warnings.filterwarnings('ignore')
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import rasterio
-from rasterstats import zonal_stats
+from rasterio.errors import WindowError
+from rasterio.features import geometry_mask, geometry_window, rasterize
+from rasterio.transform import from_bounds
 import matplotlib.pyplot as plt
-import seaborn as sns
+from matplotlib.colors import Normalize
 
 # -------------------------
 # Rutas
 # -------------------------
 RASTER_PATH = 'data/raw/raster/tmin_peru.tif'
 VECTORS_ZIP = 'data/raw/vectors/DISTRITOS_LIMITES.zip'
+VECTORS_URI = f'zip://{VECTORS_ZIP}'
 OUT_DIR     = 'data/processed'
 CSV_OUT     = os.path.join(OUT_DIR, 'tmin_zonal_distritos.csv')
 PNG_OUT     = os.path.join(OUT_DIR, 'tmin_choropleth.png')
+HIST_OUT    = os.path.join(OUT_DIR, 'histogramas_tmin.json')
+BUNDLE_OUT  = os.path.join(OUT_DIR, 'tmin_bundle.parquet')
+BUNDLE_TMP  = BUNDLE_OUT + '.tmp'  # se renombra a BUNDLE_OUT solo si la corrida termina bien
+TOP_OUT     = os.path.join(OUT_DIR, 'top15_tmin_mean_alta.csv')
+BOT_OUT     = os.path.join(OUT_DIR, 'top15_tmin_mean_baja.csv')
+COMP_OUT    = os.path.join(OUT_DIR, 'tmin_comparacion_productos.csv')
+
+DEFAULT_PRODUCT = 'tmin'
+
+BASE_COLS = ['UBIGEO', 'DEPARTAMENTO', 'PROVINCIA', 'DISTRITO']
+STATS     = ['count', 'mean', 'min', 'max', 'std', 'percentile_10', 'percentile_90']
+N_RANK    = 15
+MAP_MAX_PX = 2000  # lado mayor de la grilla del mapa en modo streaming (sobre la extensión de la capa)
+DIFF_STATS = ['mean', 'percentile_10', 'percentile_90']  # diferencias vs. el producto de referencia
+
+# Histogramas/KDE precomputados para la app (por métrica y por departamento)
+HIST_METRICS   = ['mean', 'min', 'max', 'percentile_10', 'percentile_90', 'risk_index']
+HIST_RANGE     = (-30.0, 40.0)  # °C; valores fuera del rango caen en los bins extremos
+HIST_FINE_STEP = 0.1            # bins finos acumulados durante el recorrido por bloques
+HIST_BIN_WIDTH = 0.5            # bins publicados en el artefacto
+KDE_POINTS     = 64
+FINE_EDGES = np.linspace(HIST_RANGE[0], HIST_RANGE[1],
+                         int(round((HIST_RANGE[1] - HIST_RANGE[0]) / HIST_FINE_STEP)) + 1)
 
-os.makedirs(OUT_DIR, exist_ok=True)
+# Si tu ráster estuviera en °C×10, pon scale_factor=0.1
+scale_factor = 1.0
 
 # -------------------------
 # Utilidades
@@ -41,127 +83,506 @@ def dedup_columns(cols):
 def pick(lst, default=None):
     return lst[0] if len(lst)>0 else default
 
+def positive_int(value):
+    """Tipo argparse: entero > 0 (para --chunk-size)."""
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'se esperaba un entero, no {value!r}')
+    if n <= 0:
+        raise argparse.ArgumentTypeError(f'debe ser un entero positivo, no {n}')
+    return n
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Estadísticas zonales de Tmin por distrito.')
+    parser.add_argument(
+        '--chunk-size', type=positive_int, default=None,
+        help='Procesa los polígonos en bloques de N features y escribe el CSV de forma '
+             'incremental (memoria acotada por el bloque). Por defecto se lee todo de una vez.'
+    )
+    parser.add_argument(
+        '--raster', action='append', metavar='NOMBRE=RUTA', default=None,
+        help='Ráster Tmin a procesar (repetible). Deben estar co-registrados; el primero es la '
+             'referencia para mapa, rankings y diferencias. '
+             f'Por defecto: {DEFAULT_PRODUCT}={RASTER_PATH}.'
+    )
+    return parser.parse_args()
+
+def parse_products(specs):
+    """['nombre=ruta', ...] → {nombre: ruta} en orden (el primero es la referencia)."""
+    if not specs:
+        return {DEFAULT_PRODUCT: RASTER_PATH}
+    products = {}
+    for spec in specs:
+        name, sep, path = spec.partition('=')
+        if not sep:  # solo ruta → nombre = archivo sin extensión
+            name, path = os.path.splitext(os.path.basename(spec))[0], spec
+        if name in products:
+            raise ValueError(f'Producto repetido en --raster: {name}')
+        products[name] = path
+    return products
+
+def open_products(products):
+    """Abre los rásters y verifica que compartan grilla (CRS, transform y tamaño)."""
+    datasets = {}
+    for name, path in products.items():
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'No se encontró el raster en {path}')
+        datasets[name] = rasterio.open(path)
+
+    ref_name, ref = next(iter(datasets.items()))
+    for name, ds in datasets.items():
+        if (ds.crs, ds.transform, ds.shape) != (ref.crs, ref.transform, ref.shape):
+            raise ValueError(f'El ráster {name} no está co-registrado con {ref_name} '
+                             '(CRS, resolución o extensión distintos)')
+    return datasets
+
 # -------------------------
-# Leer distritos desde ZIP
+# Lectura de distritos
 # -------------------------
-gdf = gpd.read_file(f'zip://{VECTORS_ZIP}')
+def normalize_districts(gdf):
+    """
+    Deduplica/renombra columnas clave, asegura WGS84 y conserva solo atributos básicos.
+    Las columnas de salida tienen nombres únicos (col, col_1, ...) y el mismo orden en todos los bloques.
+    """
+    # Deduplicar nombres de columnas para evitar el error
+    gdf = gdf.copy()
+    gdf.columns = dedup_columns(gdf.columns)
+
+    # Intentar detectar columnas clave
+    cand_ubigeo = [c for c in gdf.columns if 'UBIGEO' in c.upper() or c.upper()=='UBIGEO']
+    cand_dep    = [c for c in gdf.columns if 'DEP' in c.upper() or 'DEPART' in c.upper()]
+    cand_pro    = [c for c in gdf.columns if 'PROV' in c.upper()]
+    cand_dis    = [c for c in gdf.columns if 'DIST' in c.upper()]
 
-# Deduplicar nombres de columnas para evitar el error
-gdf = gdf.copy()
-gdf.columns = dedup_columns(gdf.columns)
+    ubigeo_col = pick(cand_ubigeo)
+    dep_col    = pick(cand_dep)
+    pro_col    = pick(cand_pro)
+    dis_col    = pick(cand_dis)
 
-# Intentar detectar columnas clave
-cand_ubigeo = [c for c in gdf.columns if 'UBIGEO' in c.upper() or c.upper()=='UBIGEO']
-cand_dep    = [c for c in gdf.columns if 'DEP' in c.upper() or 'DEPART' in c.upper()]
-cand_pro    = [c for c in gdf.columns if 'PROV' in c.upper()]
-cand_dis    = [c for c in gdf.columns if 'DIST' in c.upper()]
+    rename_map = {}
+    if ubigeo_col: rename_map[ubigeo_col] = 'UBIGEO'
+    if dep_col:    rename_map[dep_col]    = 'DEPARTAMENTO'
+    if pro_col:    rename_map[pro_col]    = 'PROVINCIA'
+    if dis_col:    rename_map[dis_col]    = 'DISTRITO'
+    gdf = gdf.rename(columns=rename_map)
 
-ubigeo_col = pick(cand_ubigeo)
-dep_col    = pick(cand_dep)
-pro_col    = pick(cand_pro)
-dis_col    = pick(cand_dis)
+    # Asegurar CRS WGS84
+    if gdf.crs is None or gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs(4326)
 
-rename_map = {}
-if ubigeo_col: rename_map[ubigeo_col] = 'UBIGEO'
-if dep_col:    rename_map[dep_col]    = 'DEPARTAMENTO'
-if pro_col:    rename_map[pro_col]    = 'PROVINCIA'
-if dis_col:    rename_map[dis_col]    = 'DISTRITO'
-gdf = gdf.rename(columns=rename_map)
+    # Conservar solo atributos básicos + geometry (evita problemas)
+    #   → renombrar puede repetir etiquetas (p.ej. dos PROVINCIA): se vuelven a deduplicar
+    keep_cols = [c for c in BASE_COLS if c in gdf.columns]
+    gdf = gdf[keep_cols + ['geometry']].reset_index(drop=True)
+    gdf.columns = dedup_columns(gdf.columns)
+    return gdf
 
-# Asegurar CRS WGS84
-if gdf.crs is None or gdf.crs.to_epsg() != 4326:
-    gdf = gdf.to_crs(4326)
+def iter_district_chunks(chunk_size=None):
+    """
+    Itera los distritos del ZIP ya normalizados.
+    Sin chunk_size devuelve un único bloque con toda la capa; con chunk_size lee
+    bloques de N features (geopandas `rows=slice`, vía pyogrio/fiona) hasta agotar la capa.
+    """
+    if not chunk_size:
+        yield normalize_districts(gpd.read_file(VECTORS_URI))
+        return
 
-# Conservar solo atributos básicos + geometry (evita problemas)
-keep_cols = [c for c in ['UBIGEO','DEPARTAMENTO','PROVINCIA','DISTRITO'] if c in gdf.columns]
-gdf_min = gdf[keep_cols + ['geometry']].copy()
+    start = 0
+    while True:
+        chunk = gpd.read_file(VECTORS_URI, rows=slice(start, start + chunk_size))
+        if chunk.empty:
+            break
+        yield normalize_districts(chunk)
+        start += chunk_size
 
 # -------------------------
-# Leer raster
+# Estadísticas zonales
 # -------------------------
-if not os.path.exists(RASTER_PATH):
-    raise FileNotFoundError(f'No se encontró el raster en {RASTER_PATH}')
-rds = rasterio.open(RASTER_PATH)
+def zone_masks(gdf_chunk, ref_ds):
+    """
+    Ventana + máscara de cada polígono sobre la grilla común (píxeles cuyo centro cae
+    dentro del polígono, como rasterstats). Se calcula una vez por bloque y se reutiliza
+    en todos los rásters; None si el polígono está vacío o fuera del ráster.
+    """
+    zones = []
+    for geom in gdf_chunk.geometry:
+        if geom is None or geom.is_empty:
+            zones.append(None)
+            continue
+        try:
+            win = geometry_window(ref_ds, [geom])
+        except WindowError:
+            zones.append(None)
+            continue
+        mask = geometry_mask([geom], out_shape=(int(win.height), int(win.width)),
+                             transform=ref_ds.window_transform(win), invert=True)
+        zones.append((win, mask))
+    return zones
 
-# Si tu ráster estuviera en °C×10, pon scale_factor=0.1
-scale_factor = 1.0
+def raster_zone_stats(ds, zones, deps, acc):
+    """
+    STATS (en unidades del ráster) por zona. El histograma fino de píxeles (en °C) de cada
+    zona se suma directamente en `acc['Nacional']` y `acc[departamento]`, sin guardarlo por zona.
+    """
+    rows = []
+    for zone, dep in zip(zones, deps):
+        vals = np.array([], dtype='float64')
+        if zone is not None:
+            win, mask = zone
+            arr = ds.read(1, window=win, masked=True)
+            vals = arr[mask].compressed().astype('float64')
+            vals = vals[np.isfinite(vals)]
+
+        if vals.size == 0:
+            rows.append({'count': 0})
+            continue
+        counts = fine_counts(vals * (1/scale_factor))
+        for scope in ('Nacional',) if dep is None else ('Nacional', dep):
+            series = acc.setdefault(scope, {})
+            series.setdefault('pixels', np.zeros(len(FINE_EDGES) - 1, dtype='int64'))
+            series['pixels'] += counts
+        rows.append({
+            'count': int(vals.size),
+            'mean': vals.mean(),
+            'min': vals.min(),
+            'max': vals.max(),
+            'std': vals.std(),
+            'percentile_10': np.percentile(vals, 10),
+            'percentile_90': np.percentile(vals, 90),
+        })
+    return pd.DataFrame(rows, columns=STATS).astype({c: float for c in STATS if c != 'count'})
+
+def compute_chunk_stats(gdf_chunk, datasets, hist_acc):
+    """
+    Estadísticas zonales + índice de riesgo de un bloque de distritos para cada producto.
+    La rasterización de los polígonos se comparte entre todos los rásters; los histogramas
+    de píxeles se acumulan en `hist_acc[producto]`.
+    Devuelve (atributos, {producto: stats}).
+    """
+    zones = zone_masks(gdf_chunk, next(iter(datasets.values())))
+    attrs = pd.DataFrame(gdf_chunk.drop(columns='geometry'))
+    deps = department_labels(attrs)
+
+    stats = {}
+    for name, ds in datasets.items():
+        df_stats = raster_zone_stats(ds, zones, deps, hist_acc[name])
+
+        # Reescalar si corresponde
+        if scale_factor != 1.0:
+            for c in ['mean','min','max','std','percentile_10','percentile_90']:
+                if c in df_stats:
+                    df_stats[c] = df_stats[c] * (1/scale_factor)
+
+        # Índice personalizado de riesgo por frío
+        p10 = df_stats['percentile_10']
+        risk_index = np.maximum(0, 5 - p10)               # >0 si p10<5°C
+        risk_flag  = (df_stats['mean'] < 0).astype(int)   # 1 si Tmin media<0°C
+        df_stats['risk_index'] = risk_index
+        df_stats['risk_flag']  = risk_flag
+
+        stats[name] = df_stats
+    return attrs, stats
+
+def compare_products(attrs, stats, ref):
+    """
+    Tablas de comparación de un bloque:
+      - larga: una fila por distrito y producto (+ diferencias vs. la referencia si hay varios) → bundle
+      - ancha: productos lado a lado por distrito + diferencias → COMP_OUT
+    """
+    ref_stats = stats[ref]
+    multi = len(stats) > 1
+
+    long_parts, wide_parts = [], [attrs]
+    for name, df_stats in stats.items():
+        diffs = pd.DataFrame(
+            {f'diff_{c}': df_stats[c] - ref_stats[c] for c in DIFF_STATS} if multi else {},
+            index=df_stats.index
+        )
+        product = pd.DataFrame({'PRODUCTO': name}, index=attrs.index)
+        long_parts.append(pd.concat([attrs, product, df_stats, diffs], axis=1))
+        wide_parts.append(df_stats[DIFF_STATS].add_suffix(f'_{name}'))
+        if name != ref:
+            wide_parts.append(diffs.add_suffix(f'_{name}'))
+    return pd.concat(long_parts, ignore_index=True), pd.concat(wide_parts, axis=1)
+
+def update_rankings(top, bot, out_chunk):
+    """Mantiene solo los N_RANK distritos más cálidos/fríos vistos hasta ahora (None al inicio)."""
+    top = out_chunk if top is None else pd.concat([top, out_chunk])
+    bot = out_chunk if bot is None else pd.concat([bot, out_chunk])
+    return top.nlargest(N_RANK, 'mean'), bot.nsmallest(N_RANK, 'mean')
 
 # -------------------------
-# Estadísticas zonales
-#   → pasamos SOLO geometrías para evitar atributos duplicados
-# -------------------------
-shapes = [geom.__geo_interface__ for geom in gdf_min.geometry]
-zs = zonal_stats(
-    shapes,
-    RASTER_PATH,
-    stats=['count','mean','min','max','std','percentile_10','percentile_90'],
-    nodata=rds.nodata,
-    geojson_out=False
-)
-df_stats = pd.DataFrame(zs)
-
-# Reescalar si corresponde
-if scale_factor != 1.0:
-    for c in ['mean','min','max','std','percentile_10','percentile_90']:
-        if c in df_stats:
-            df_stats[c] = df_stats[c] * (1/scale_factor)
-
-# Índice personalizado de riesgo por frío
-p10 = df_stats['percentile_10']
-risk_index = np.maximum(0, 5 - p10)               # >0 si p10<5°C
-risk_flag  = (df_stats['mean'] < 0).astype(int)   # 1 si Tmin media<0°C
-df_stats['risk_index'] = risk_index
-df_stats['risk_flag']  = risk_flag
-
-# Unir (atributos básicos + stats)
-out = pd.concat([gdf_min[keep_cols].reset_index(drop=True), df_stats], axis=1)
-
-# Guardar CSV
-os.makedirs(OUT_DIR, exist_ok=True)
-out.to_csv(CSV_OUT, index=False, encoding='utf-8')
-print(f'✓ CSV guardado en {CSV_OUT}')
-
-# -------------------------
-# Mapa estático
-# -------------------------
-gplot = gdf_min.join(df_stats[['mean']], how='left')
-fig, ax = plt.subplots(figsize=(7.5, 9))
-gplot.plot(column='mean', legend=True, linewidth=0.1, edgecolor='black', ax=ax)
-ax.set_title('Temperatura mínima media (Tmin) – Distritos')
-ax.set_axis_off()
-plt.tight_layout()
-plt.savefig(PNG_OUT, dpi=200)
-plt.close()
-print(f'✓ Mapa PNG guardado en {PNG_OUT}')
-
-# Histograma de la Tmin promedio
-plt.figure(figsize=(12, 6))
-sns.histplot(out['mean'], kde=True, bins=30, color='skyblue', edgecolor='black')
-
-plt.title('Distribución de Temperatura Mínima Promedio (°C) en Distritos del Perú')
-plt.xlabel('Temperatura Mínima Promedio (°C)')
-plt.ylabel('Número de Distritos')
-
-plt.axvline(out['mean'].mean(), color='red', linestyle='--',
-            label=f'Media: {out["mean"].mean():.2f}°C')
-plt.axvline(out['mean'].median(), color='green', linestyle='--',
-            label=f'Mediana: {out["mean"].median():.2f}°C')
-
-plt.legend()
-plt.tight_layout()
-
-# Guardar histograma
-hist_png = os.path.join(OUT_DIR, 'histograma_tmin.png')
-plt.savefig(hist_png, dpi=300)
-plt.close()
-print(f'✓ Histograma guardado en {hist_png}')
-
-# Top/Bottom 15
-top_csv  = os.path.join(OUT_DIR, 'top15_tmin_mean_alta.csv')
-bot_csv  = os.path.join(OUT_DIR, 'top15_tmin_mean_baja.csv')
-rank_cols = keep_cols + ['mean','percentile_10','percentile_90','risk_index','risk_flag']
-
-out.sort_values('mean', ascending=False).head(15)[rank_cols].to_csv(top_csv, index=False, encoding='utf-8')
-out.sort_values('mean', ascending=True ).head(15)[rank_cols].to_csv(bot_csv, index=False, encoding='utf-8')
-print('✓ Rankings top/bottom 15 exportados')
-print('Listo ✅')
+# Salidas gráficas
+# -------------------------
+def plot_choropleth(gdf, means):
+    """Coropleta vectorial (modo en memoria): polígonos con borde, escala de la Tmin media."""
+    gplot = gdf.assign(mean=means)
+    fig, ax = plt.subplots(figsize=(7.5, 9))
+    gplot.plot(column='mean', legend=True, linewidth=0.1, edgecolor='black', ax=ax)
+    save_map(ax)
+
+def plot_choropleth_streaming(chunks, means, bounds):
+    """
+    Coropleta en modo streaming: quema la Tmin media de cada bloque en una grilla fija de
+    MAP_MAX_PX (lado mayor) sobre la extensión de la capa y la dibuja con un solo imshow.
+    La memoria del mapa es la de esa grilla, no la de los vértices de todos los polígonos.
+    """
+    west, south, east, north = bounds
+    span = max(east - west, north - south)
+    width  = max(1, int(round(MAP_MAX_PX * (east - west) / span)))
+    height = max(1, int(round(MAP_MAX_PX * (north - south) / span)))
+    transform = from_bounds(west, south, east, north, width, height)
+    grid = np.full((height, width), np.nan, dtype='float32')
+
+    start = 0
+    for chunk in chunks:
+        vals = means[start:start + len(chunk)]
+        burn = [(g, v) for g, v in zip(chunk.geometry, vals)
+                if g is not None and not g.is_empty and np.isfinite(v)]
+        if burn:
+            rasterize(burn, out=grid, transform=transform, all_touched=True)
+        start += len(chunk)
+
+    norm = Normalize(vmin=np.nanmin(means), vmax=np.nanmax(means))
+    fig, ax = plt.subplots(figsize=(7.5, 9))
+    img = ax.imshow(grid, norm=norm, extent=(west, east, south, north), interpolation='nearest')
+    fig.colorbar(img, ax=ax)
+    save_map(ax)
+
+def save_map(ax):
+    ax.set_title('Temperatura mínima media (Tmin) – Distritos')
+    ax.set_axis_off()
+    plt.tight_layout()
+    plt.savefig(PNG_OUT, dpi=200)
+    plt.close()
+    print(f'✓ Mapa PNG guardado en {PNG_OUT}')
+
+# -------------------------
+# Histogramas / KDE
+# -------------------------
+def fine_counts(values):
+    """Conteos sobre los bins finos comunes (valores fuera de HIST_RANGE → bins extremos)."""
+    v = np.asarray(values, dtype=float)
+    v = np.clip(v[np.isfinite(v)], *HIST_RANGE)
+    return np.histogram(v, bins=FINE_EDGES)[0]
+
+def department_labels(df):
+    """Departamento de cada fila como texto; None si falta (esa fila solo cuenta en 'Nacional')."""
+    if 'DEPARTAMENTO' not in df.columns:
+        return pd.Series(None, index=df.index, dtype=object)
+    deps = df['DEPARTAMENTO']
+    return deps.astype(str).where(deps.notna(), None)
+
+def accumulate_histograms(acc, out_chunk):
+    """
+    Suma los conteos finos de HIST_METRICS del bloque en `acc[ámbito][serie]`
+    (la serie 'pixels' ya se acumula en raster_zone_stats).
+    Ámbitos: 'Nacional' + cada departamento.
+    """
+    scopes = {'Nacional': np.ones(len(out_chunk), dtype=bool)}
+    deps = department_labels(out_chunk)
+    for dep in deps.dropna().unique():
+        scopes[dep] = (deps == dep).to_numpy()
+
+    for scope, mask in scopes.items():
+        series = acc.setdefault(scope, {})
+        for m in HIST_METRICS:
+            series[m] = series.get(m, 0) + fine_counts(out_chunk.loc[mask, m])
+
+def summarize_histogram(fine):
+    """
+    Reduce los conteos finos a bins de HIST_BIN_WIDTH recortados al rango con datos,
+    más una KDE gaussiana (regla de Scott) calculada sobre los bins finos y escalada a conteos.
+    """
+    n = int(fine.sum())
+    if n == 0:
+        return None
+
+    factor = int(round(HIST_BIN_WIDTH / HIST_FINE_STEP))
+    nz = np.flatnonzero(fine)
+    lo = nz[0] // factor * factor
+    hi = (nz[-1] // factor + 1) * factor
+    counts = fine[lo:hi].reshape(-1, factor).sum(axis=1)
+
+    centers = (FINE_EDGES[:-1] + FINE_EDGES[1:]) / 2
+    c, w = centers[nz], fine[nz]
+    mu = np.average(c, weights=w)
+    sd = np.sqrt(np.average((c - mu) ** 2, weights=w))
+    median = centers[np.searchsorted(np.cumsum(fine), n / 2)]
+    bw = max(sd * n ** (-1 / 5), HIST_FINE_STEP)
+
+    x = np.linspace(FINE_EDGES[lo], FINE_EDGES[hi], KDE_POINTS)
+    dens = (w * np.exp(-0.5 * ((x[:, None] - c[None, :]) / bw) ** 2)).sum(axis=1) / (n * bw * np.sqrt(2 * np.pi))
+
+    return {
+        'n': n,
+        'mean': round(float(mu), 3),
+        'median': round(float(median), 3),
+        'start': round(float(FINE_EDGES[lo]), 3),
+        'counts': counts.tolist(),
+        'kde_range': [round(float(x[0]), 3), round(float(x[-1]), 3)],
+        'kde': np.round(dens * n * HIST_BIN_WIDTH, 3).tolist(),
+    }
+
+def export_histograms(acc_by_product, ref):
+    """Guarda el artefacto compacto (JSON) que la app usa para dibujar histogramas interactivos."""
+    products = {}
+    for name, acc in acc_by_product.items():
+        scopes = {}
+        for scope in ['Nacional'] + sorted(k for k in acc if k != 'Nacional'):
+            series = {k: summarize_histogram(v) for k, v in acc[scope].items()}
+            scopes[scope] = {k: v for k, v in series.items() if v is not None}
+        products[name] = scopes
+
+    payload = {'bin_width': HIST_BIN_WIDTH, 'reference': ref, 'products': products}
+    with open(HIST_OUT, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, separators=(',', ':'))
+    print(f'✓ Histogramas/KDE guardados en {HIST_OUT}')
+
+# -------------------------
+# Bundle para la app
+# -------------------------
+def write_bundle_chunk(writer, long_chunk, meta):
+    """
+    Añade un bloque de la tabla larga (distrito × producto) al Parquet (zstd) BUNDLE_TMP.
+    En el primer bloque abre el writer con los metadatos de la corrida en el esquema (clave `tmin_meta`).
+    """
+    table = pa.Table.from_pandas(long_chunk, preserve_index=False)
+    if writer is None:
+        # Atributos vacíos en el primer bloque se infieren como null → forzar texto
+        schema = pa.schema([f.with_type(pa.string()) if pa.types.is_null(f.type) else f
+                            for f in table.schema])
+        schema = schema.with_metadata({'tmin_meta': json.dumps(meta, ensure_ascii=False)})
+        writer = pq.ParquetWriter(BUNDLE_TMP, schema, compression='zstd')
+    writer.write_table(table.cast(writer.schema))
+    return writer
+
+# -------------------------
+# Main
+# -------------------------
+def main():
+    args = parse_args()
+    os.makedirs(OUT_DIR, exist_ok=True)
+
+    # Rásters co-registrados (el primero es la referencia); se leen ventanas por polígono
+    products = parse_products(args.raster)
+    ref = next(iter(products))
+    multi = len(products) > 1
+    datasets = open_products(products)
+
+    # Metadatos de la corrida que viajan en el bundle
+    artifacts = {
+        'csv': os.path.basename(CSV_OUT),
+        'top_csv': os.path.basename(TOP_OUT),
+        'bot_csv': os.path.basename(BOT_OUT),
+        'map_png': os.path.basename(PNG_OUT),
+        'hist_json': os.path.basename(HIST_OUT),
+    }
+    if multi:
+        artifacts['comparison_csv'] = os.path.basename(COMP_OUT)
+    elif os.path.exists(COMP_OUT):
+        # Una comparación de una corrida anterior ya no corresponde a este bundle
+        os.remove(COMP_OUT)
+    meta = {
+        'generated_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'products': products,
+        'reference': ref,
+        'vectors': VECTORS_ZIP,
+        'scale_factor': scale_factor,
+        'artifacts': artifacts,
+    }
+
+    # En modo streaming la capa se relee para el mapa; en memoria se reutiliza el único bloque
+    chunks = iter_district_chunks(args.chunk_size)
+    if not args.chunk_size:
+        chunks = list(chunks)
+
+    # Estadísticas por bloque → CSV/bundle incrementales + rankings e histogramas acumulados
+    top = bot = None
+    hist_acc = {name: {} for name in products}
+    bundle_writer = None
+    columns = None
+    n_total = 0
+    #   → el bundle se escribe en BUNDLE_TMP y el writer se cierra pase lo que pase:
+    #     si la corrida falla, nunca queda un Parquet sin footer en BUNDLE_OUT
+    ref_bounds = datasets[ref].bounds
+    bounds = None  # extensión de la capa (para la grilla del mapa en modo streaming)
+    completed = False
+    try:
+        for i, gdf_chunk in enumerate(chunks):
+            attrs, stats = compute_chunk_stats(gdf_chunk, datasets, hist_acc)
+
+            # Producto de referencia → CSV principal + rankings (mismo formato que con un solo ráster)
+            out_chunk = pd.concat([attrs, stats[ref]], axis=1)
+            if columns is None:
+                columns = list(out_chunk.columns)
+                out_chunk.to_csv(CSV_OUT, index=False, encoding='utf-8')
+            elif list(out_chunk.columns) != columns:
+                raise ValueError(f'El bloque {i + 1} tiene columnas distintas al primero: '
+                                 f'{list(out_chunk.columns)} != {columns}')
+            else:
+                out_chunk.to_csv(CSV_OUT, mode='a', header=False, index=False, encoding='utf-8')
+            top, bot = update_rankings(top, bot, out_chunk)
+
+            for name, df_stats in stats.items():
+                accumulate_histograms(hist_acc[name], pd.concat([attrs, df_stats], axis=1))
+
+            # Todos los productos → bundle (formato largo) + CSV de comparación lado a lado
+            long_chunk, wide_chunk = compare_products(attrs, stats, ref)
+            bundle_writer = write_bundle_chunk(bundle_writer, long_chunk, meta)
+            if multi:
+                wide_chunk.to_csv(COMP_OUT, mode='w' if i == 0 else 'a', header=i == 0,
+                                  index=False, encoding='utf-8')
+
+            n_total += len(out_chunk)
+            b = gdf_chunk.total_bounds
+            bounds = b if bounds is None else np.concatenate([np.minimum(bounds[:2], b[:2]),
+                                                              np.maximum(bounds[2:], b[2:])])
+            if args.chunk_size:
+                print(f'  · bloque {i + 1}: {n_total} distritos procesados')
+
+        if columns is None:
+            raise ValueError(f'No se encontraron polígonos en {VECTORS_ZIP}')
+        completed = True
+    finally:
+        if bundle_writer is not None:
+            bundle_writer.close()
+        if not completed and os.path.exists(BUNDLE_TMP):
+            os.remove(BUNDLE_TMP)
+        for ds in datasets.values():
+            ds.close()
+    os.replace(BUNDLE_TMP, BUNDLE_OUT)
+    print(f'✓ CSV guardado en {CSV_OUT}')
+    print(f'✓ Bundle guardado en {BUNDLE_OUT}')
+    if multi:
+        print(f'✓ Comparación de {len(products)} productos guardada en {COMP_OUT}')
+
+    # Solo la columna `mean` (un float por distrito) vuelve a memoria para el mapa
+    means = pd.read_csv(CSV_OUT, usecols=['mean'])['mean']
+
+    # -------------------------
+    # Mapa estático (producto de referencia)
+    # -------------------------
+    if args.chunk_size:
+        # Extensión de la capa recortada al ráster: fuera de él no hay valores que pintar
+        rb = ref_bounds
+        bounds = (max(bounds[0], rb.left), max(bounds[1], rb.bottom),
+                  min(bounds[2], rb.right), min(bounds[3], rb.top))
+        plot_choropleth_streaming(iter_district_chunks(args.chunk_size), means.to_numpy(), bounds)
+    else:
+        plot_choropleth(chunks[0], means.to_numpy())
+    export_histograms(hist_acc, ref)
+
+    # Top/Bottom 15
+    keep_cols = [c for c in columns if c not in STATS + ['risk_index', 'risk_flag']]
+    rank_cols = keep_cols + ['mean','percentile_10','percentile_90','risk_index','risk_flag']
+
+    top.sort_values('mean', ascending=False)[rank_cols].to_csv(TOP_OUT, index=False, encoding='utf-8')
+    bot.sort_values('mean', ascending=True )[rank_cols].to_csv(BOT_OUT, index=False, encoding='utf-8')
+    print('✓ Rankings top/bottom 15 exportados')
+    print('Listo ✅')
+
+
+if __name__ == '__main__':
+    main()